@@ -0,0 +1,100 @@
+""" io_uring send backend for ClusterDTester.
+
+Instead of one `sendmsg` system call per file, the BUF header and data of a
+whole batch of files are queued on an io_uring and handed to the kernel with
+a single `io_uring_enter`. The entries are linked so the kernel sends them in
+order on the stream. Needs the `liburing` Python bindings, which in turn need
+Linux 6.14 or later; importing this module raises ImportError without them.
+"""
+import socket
+from pathlib import Path
+from typing import List, Optional
+
+from liburing import (Cqe, FileIndex, IORING_SETUP_SQPOLL, IOSQE_FIXED_FILE, IOSQE_IO_LINK, Ring,
+                      io_uring_cqe_seen, io_uring_get_sqe, io_uring_prep_send, io_uring_queue_exit,
+                      io_uring_queue_init, io_uring_register_files, io_uring_sqe_set_flags,
+                      io_uring_submit, io_uring_wait_cqe)
+
+class IoUringSender:
+    def __init__(self, sock: socket.socket, header: bytes, batch_size: int = 32, sqpoll: bool = False):
+        """ Set up an io_uring for sending files over a connected socket.
+
+        Args:
+        sock (socket.socket): The connected socket. It must be in blocking mode,
+                              since io_uring reports EAGAIN on non-blocking ones
+                              instead of waiting for buffer space.
+        header (bytes): The header sent ahead of the data of every file.
+        batch_size (int): The number of files queued before they are submitted.
+                          Default is 32.
+        sqpoll (bool): Let a kernel thread poll the submission queue, so that
+                       submitting needs no system call at all. Default is False.
+        """
+        self.header = header
+        self.batch_size = batch_size
+        self.ring = Ring()
+        self.cqe = Cqe()
+        # every file takes two entries, one for the header and one for the data
+        io_uring_queue_init(2 * batch_size, self.ring, IORING_SETUP_SQPOLL if sqpoll else 0)
+        try:
+            # a registered file skips the fd table lookup on every send
+            # the bindings need the index kept alive for as long as the ring uses it
+            self._files = FileIndex([sock.fileno()])
+            io_uring_register_files(self.ring, self._files)
+        except Exception:
+            io_uring_queue_exit(self.ring)
+            raise
+        # buffers of the queued sends, kept alive until the kernel is done with them
+        self._buffers: List[bytes] = []
+        self._last_sqe = None
+        self.queued_files = 0
+
+    def _prep_send(self, data: bytes) -> None:
+        """ queue a send of `data`, linked to the send queued before it. """
+        sqe = io_uring_get_sqe(self.ring)
+        # MSG_WAITALL makes the kernel retry short sends rather than break the chain
+        io_uring_prep_send(sqe, 0, data, socket.MSG_WAITALL)
+        io_uring_sqe_set_flags(sqe, IOSQE_FIXED_FILE | IOSQE_IO_LINK)
+        sqe.user_data = len(self._buffers)
+        self._buffers.append(data)
+        self._last_sqe = sqe
+
+    def queue_file(self, file_path: Path) -> None:
+        """ queue the BUF header and data of a file, submitting the batch once it is full.
+        The bindings only accept `bytes`, so the data is read rather than mapped. """
+        with open(file_path, 'rb', buffering=0) as file:
+            rdf_data = file.read()
+        self._prep_send(self.header)
+        if rdf_data:
+            self._prep_send(rdf_data)
+        self.queued_files += 1
+        if self.queued_files == self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """ submit all queued sends and wait until the kernel has completed them. """
+        if not self._buffers:
+            return
+        # the last entry ends the chain
+        io_uring_sqe_set_flags(self._last_sqe, IOSQE_FIXED_FILE)
+        io_uring_submit(self.ring)
+        error: Optional[OSError] = None
+        for _ in range(len(self._buffers)):
+            io_uring_wait_cqe(self.ring, self.cqe)
+            entry = self.cqe[0]
+            try:
+                # a failed entry raises here, and cancels the ones linked after it
+                sent = entry.res
+                if sent != len(self._buffers[entry.user_data]):
+                    raise OSError(f"Short send of {sent} bytes through io_uring")
+            except OSError as e:
+                error = error or e
+            io_uring_cqe_seen(self.ring, entry)
+        self._buffers.clear()
+        self._last_sqe = None
+        self.queued_files = 0
+        if error is not None:
+            raise error
+
+    def close(self) -> None:
+        """ tear down the io_uring. Queued sends that were not flushed are dropped. """
+        io_uring_queue_exit(self.ring)
@@ -1,10 +1,21 @@
 import argparse
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import functools
 import logging
+import logging.handlers
+import mmap
+import os
+import queue
 import socket
+import struct
 import sys
+import threading
 import time
 from pathlib import Path
-from typing import List, Tuple
+from typing import Deque, Iterator, Optional, Tuple
 import datetime
 
 class NoAcknowledgmentError(Exception):
@@ -19,10 +30,194 @@ class ServerResponseError(Exception):
     """Exception raised for unexpected server responses."""
     pass
 
+class _ResponseReader:
+    """ Split the byte stream from a socket into newline-terminated messages.
+
+    Data is received straight into a caller-supplied bytearray with
+    `recv_into`, so reading a response allocates nothing but the returned
+    message. The buffer is doubled in place if a single message outgrows it.
+    """
+    def __init__(self, sock: socket.socket, buf: bytearray):
+        self.sock = sock
+        self.buf = buf
+        self.view = memoryview(buf)
+        # number of bytes received into buf that have not been returned yet
+        self.write_off = 0
+
+    def _grow(self):
+        """ double the size of the buffer, keeping its contents. """
+        self.view.release()
+        self.buf.extend(bytes(len(self.buf)))
+        self.view = memoryview(self.buf)
+
+    def read_message(self) -> bytes:
+        """ return the next message from the server without its line ending. """
+        # a previous read may already hold a complete message after the last one
+        end = self.buf.find(b"\n", 0, self.write_off)
+        while end < 0:
+            scan_from = self.write_off
+            if self.write_off == len(self.buf):
+                self._grow()
+            n = self.sock.recv_into(self.view[self.write_off:])
+            if not n:
+                raise ConnectionError("Connection closed by server")
+            self.write_off += n
+            end = self.buf.find(b"\n", scan_from, self.write_off)
+        message_end = end - 1 if end and self.buf[end - 1] == ord("\r") else end
+        message = bytes(self.view[:message_end])
+        # move whatever follows the delimiter to the front of the buffer
+        tail = self.write_off - (end + 1)
+        if tail:
+            self.buf[:tail] = self.buf[end + 1:self.write_off]
+        self.write_off = tail
+        return message
+
+    def close(self):
+        """ release the view of the buffer so it can be reused and resized elsewhere. """
+        self.view.release()
+
+class _BufPool:
+    """ Receive buffers shared by all testers, handed out last in, first out. """
+    _free: queue.LifoQueue = queue.LifoQueue()
+    _watermark = 0
+
+    @classmethod
+    def get(cls, size: int) -> bytearray:
+        """ take a buffer of at least `size` bytes from the pool, or allocate one. """
+        size = max(size, cls._watermark)
+        try:
+            buf = cls._free.get_nowait()
+        except queue.Empty:
+            return bytearray(size)
+        return buf if len(buf) >= size else bytearray(size)
+
+    @classmethod
+    def put(cls, buf: bytearray) -> None:
+        """ give a buffer back to the pool. """
+        cls._watermark = max(cls._watermark, len(buf))
+        cls._free.put(buf)
+
+def _sendmsg_all(sock: socket.socket, header: bytes, body) -> None:
+    """ send a header and body with one scatter-gather call, finishing off
+    with `sendall` if the kernel accepted only part of them. """
+    sent = sock.sendmsg([header, body])
+    if sent < len(header):
+        sock.sendall(header[sent:])
+        sent = len(header)
+    if sent - len(header) < len(body):
+        sock.sendall(body[sent - len(header):])
+
+def _sendfile_corked(sock: socket.socket, header: bytes, file) -> None:
+    """ send a header followed by a whole file with `socket.sendfile`, without
+    the header leaving as a segment of its own. Where MSG_MORE is available
+    the header is sent with it, telling the kernel that more of the message
+    follows; otherwise the socket is corked around both calls if TCP_CORK is. """
+    if hasattr(socket, "MSG_MORE"):
+        sock.sendall(header, socket.MSG_MORE)
+        sock.sendfile(file)
+        return
+    cork = hasattr(socket, "TCP_CORK")
+    if cork:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1)
+    try:
+        sock.sendall(header)
+        sock.sendfile(file)
+    finally:
+        if cork:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 0)
+
+def iter_xml_files(directory: Path) -> Iterator[os.DirEntry]:
+    """ lazily yield the XML files in a directory, which is opened right away. """
+    entries = os.scandir(directory)
+
+    def xml_entries():
+        with entries:
+            for entry in entries:
+                if entry.name.endswith(".xml") and entry.is_file(follow_symlinks=False):
+                    yield entry
+    return xml_entries()
+
+@functools.lru_cache(maxsize=None)
+def _make_parser(success_prefix: bytes, error_prefix: bytes):
+    """ build a response parser specialised for one pair of prefixes. The
+    parser returns (True, None) for a success, (False, message) for an error
+    and (None, response) for anything else. Parsers are cached, so testers
+    expecting the same prefixes share one. """
+    success_len = len(success_prefix)
+    error_len = len(error_prefix)
+
+    def parse(response: bytes):
+        if response[:success_len] == success_prefix:
+            return True, None
+        if response[:error_len] == error_prefix:
+            return False, response[error_len:]
+        return None, response
+    return parse
+
+def _will_need(file_path) -> None:
+    """ ask the kernel to start reading a whole file into the page cache. """
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+def _prefetch_executor():
+    """ return a context manager giving the executor for `_prefetched`, or
+    None where the platform has no `posix_fadvise`. """
+    if hasattr(os, "posix_fadvise"):
+        # a small pool is plenty, the hints only start disk reads
+        return concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    return contextlib.nullcontext()
+
+def _prefetched(xml_files, executor: Optional[concurrent.futures.Executor], depth: int = 8) -> Iterator:
+    """ yield files from an iterable while the executor's threads prefetch the
+    next `depth` of them, so sending a file does not wait on the disk. A
+    prefetch that fails only loses the hint. Without an executor the files
+    are passed through as they are. """
+    if executor is None:
+        yield from xml_files
+        return
+    ahead = collections.deque()
+    for file_path in xml_files:
+        executor.submit(_will_need, file_path)
+        ahead.append(file_path)
+        if len(ahead) > depth:
+            yield ahead.popleft()
+    yield from ahead
+
+def _configure_logging(detailed: bool = False, verbose: bool = False) -> logging.handlers.QueueListener:
+    """ send the log of a run to a timestamped file and the console through a queue, and return its listener. """
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
+    log_filename = f"clusterd-log-{timestamp}.log"
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    file_handler = logging.FileHandler(log_filename, mode='w')  # 'w' to overwrite the log file each time
+    file_handler.setFormatter(formatter)
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.DEBUG if verbose else logging.INFO)
+    console_handler.setFormatter(formatter)
+    log_queue = queue.SimpleQueue()
+    logger = logging.getLogger(__name__)
+    logger.setLevel(logging.DEBUG if detailed else logging.INFO)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    # prevent the logger from propagating messages to the root logger
+    logger.propagate = False
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler,
+                                              respect_handler_level=True)
+    listener.start()
+    return listener
+
 class ClusterDTester:
     def __init__(self, server_ip: str, server_port: int, \
                  mode: str = "fast", \
-                 init_response: str = "+RCLUSTER Version v1.10"):
+                 init_response: str = "+RCLUSTER Version v1.10", \
+                 window: int = 1, \
+                 sendfile_threshold: int = 65536, \
+                 nodelay: bool = True, \
+                 sndbuf: int = 1 << 20, \
+                 rcvbuf: int = 1 << 20, \
+                 io_uring: bool = False, \
+                 sqpoll: bool = False):
         """ Initialize the ClusterDTester with the server IP and port, the mode of 
         operation, and the expected initial response from the server on 
         connection. 
@@ -34,47 +229,85 @@ class ClusterDTester:
                     'detailed' for a listing of clusters and duplicates.
         init_response (str): The expected initial response from the server on 
                              connection. Default is "+RCLUSTER Version v1.10".
+        window (int): The maximum number of files sent to the server whose
+                      responses have not yet been read. Default is 1, which
+                      waits for each response before sending the next file.
+                      Requests carry no length or delimiter, so values above
+                      1 need a server that finds where each BUF payload ends
+                      by itself; otherwise pipelined files run together.
+        sendfile_threshold (int): Files of at least this many bytes are sent
+                                  with `sendfile` rather than mapped. Default
+                                  is 65536.
+        nodelay (bool): Disable Nagle's algorithm on the connection so small
+                        messages are not held back waiting for ACKs. Default
+                        is True.
+        sndbuf (int): The socket send buffer size in bytes, or 0 to keep the
+                      kernel default. Default is 1 MiB.
+        rcvbuf (int): The socket receive buffer size in bytes, or 0 to keep
+                      the kernel default. Default is 1 MiB.
+        io_uring (bool): Submit the sends of up to 32 files at a time through
+                         io_uring when the `liburing` bindings are available
+                         on Linux, falling back to plain sockets otherwise.
+                         A batch is at most `window` files, so a window of 1
+                         always uses plain sockets. The
+                         socket is then blocking, with the 10 second timeout
+                         set in the kernel instead. Default is False.
+        sqpoll (bool): With io_uring, let a kernel thread poll for submissions
+                       so that sending needs no system calls. Default is False.
         """
         self.server_ip = server_ip
         self.server_port = server_port
         self.mode = mode
-        # make sure mode is either "fast" or "detailed"
-        assert self.mode in ["fast", "detailed"], "Invalid mode. Use 'fast' or 'detailed'."
+        # make sure mode is either "fast" or "detailed", and keep it as a flag for the per-file checks
+        if mode not in ("fast", "detailed"):
+            raise ValueError("Invalid mode. Use 'fast' or 'detailed'.")
+        self._detailed = mode == "detailed"
         self.init_response = init_response
+        self._buf_header = b"BUF"
         self.success_prefix = "+RCLUSTER"
         self.error_prefix = "-RCLUSTER"
+        if window <= 0:
+            raise ValueError("Invalid window. Use a positive number of in-flight files.")
+        self.window = window
+        self.sendfile_threshold = sendfile_threshold
+        self.nodelay = nodelay
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self.io_uring = io_uring
+        self.sqpoll = sqpoll
         self.sock = None
-        self.setup_logger()
-
-    def setup_logger(self):
-        """ set up the logger for ClusterDTester. """
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d-%H%M%S")
-        log_filename = f"clusterd-log-{timestamp}.log"
-        logging.basicConfig(level=logging.INFO,
-                            format='%(asctime)s - %(levelname)s - %(message)s',
-                            filename=log_filename,
-                            filemode='w')  # 'w' to overwrite the log file each time
+        # files sent to the server and awaiting a response, in send order
+        self._inflight: Deque[Tuple[Path, int]] = collections.deque()
+        self._reader = None
+        # set while sends go through io_uring
+        self._sender = None
+        # taken from _BufPool while a connection is open
+        self._rxbuf = None
+        # responses are checked as raw bytes, so keep encoded copies of what they are compared with
+        self._success_prefix_b = self.success_prefix.encode('ascii')
+        self._error_prefix_b = (self.error_prefix + ' ').encode('ascii')
+        self._init_response_b = self.init_response.encode('ascii')
+        self._parse = _make_parser(self._success_prefix_b, self._error_prefix_b)
         self.logger = logging.getLogger(__name__)
-        # add console handler to the logger
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.INFO)
-        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-        console_handler.setFormatter(formatter)
-        self.logger.addHandler(console_handler)
-        # prevent the logger from propagating messages to the root logger
-        self.logger.propagate = False
-
-    def count_xml_files(self, directory: Path) -> Tuple[int, List[Path]]:
-        """ count the number of XML files in a directory and return a list of the file paths."""
-        xml_files = list(directory.glob("*.xml"))
-        return len(xml_files), xml_files
+
+    def new_socket(self) -> socket.socket:
+        """ create an unconnected socket with the configured buffer sizes. """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # buffer sizes must be set before connecting to affect the TCP window scale
+        if self.sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        return sock
 
     def establish_connection(self) -> socket.socket:
         """ establish a connection to the server. """
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock = self.new_socket()
             sock.settimeout(10)
             sock.connect((self.server_ip, self.server_port))
+            if self.nodelay:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             return sock
         except socket.error as e:
             raise ConnectionError(f"Failed to connect to {self.server_ip}:{self.server_port}: {e}")
@@ -82,81 +315,456 @@ class ClusterDTester:
     def validate_server_acknowledgment(self, sock):
         """ validate the server's acknowledgment of the connection by
         checking the initial response. """
-        serv_init_response = sock.recv(1024).decode('utf-8')
-        if serv_init_response != self.init_response:
-            raise NoAcknowledgmentError(f"No acknowledgment from {self.server_ip}:{self.server_port}: {serv_init_response}")
+        self.check_acknowledgment(self._reader.read_message())
+
+    def check_acknowledgment(self, response: bytes):
+        """ check the initial response read from the server against the expected one. """
+        if response != self._init_response_b:
+            raise NoAcknowledgmentError(f"No acknowledgment from {self.server_ip}:{self.server_port}: {response.decode('ascii', errors='replace')}")
 
     def establish_and_validate_connection(self):
         """ establish a connection to the server and validate the server's acknowledgment. """
         if self.sock is None:
             self.sock = self.establish_connection()
+            self._rxbuf = _BufPool.get(65536)
+            self._reader = _ResponseReader(self.sock, self._rxbuf)
             self.validate_server_acknowledgment(self.sock)
+            if self.io_uring:
+                self._sender = self.open_uring_sender()
+
+    def open_uring_sender(self):
+        """ set up io_uring sends on the open connection, or return None if
+        they are not available here. """
+        if self.window == 1:
+            self.logger.warning("io_uring needs a window above 1 to batch sends, using plain sockets.")
+            return None
+        if sys.platform != "linux":
+            self.logger.warning("io_uring is only available on Linux, using plain sockets.")
+            return None
+        try:
+            from _iouring_backend import IoUringSender
+        except ImportError as e:
+            self.logger.warning(f"io_uring is not available, using plain sockets: {e}")
+            return None
+        # io_uring fails sends on a non-blocking socket with EAGAIN instead of waiting,
+        # so the timeout moves into the kernel, where a blocking socket still honours it
+        self.sock.settimeout(None)
+        timeout = struct.pack("@ll", 10, 0)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, timeout)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, timeout)
+        try:
+            return IoUringSender(self.sock, self._buf_header, min(32, self.window), self.sqpoll)
+        except OSError as e:
+            self.logger.warning(f"io_uring setup failed, using plain sockets: {e}")
+            self.sock.settimeout(10)
+            return None
+
+    def close(self):
+        """ close the connection to the server, if one is open, and give its
+        receive buffer back to the pool. """
+        if self._sender is not None:
+            self._sender.close()
+            self._sender = None
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        if self._rxbuf is not None:
+            _BufPool.put(self._rxbuf)
+            self._rxbuf = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
 
     def send_rdf_data(self, sock, file_path):
-        """ send the RDF data from a file to the server."""
-        with file_path.open('rb') as file:
-            rdf_data = file.read()
-            sock.sendall(b"BUF" + rdf_data)
+        """ send the RDF data from a file to the server. The data is never
+        copied into a Python buffer: small files are memory mapped and handed
+        to the kernel together with the BUF header, large ones are sent from
+        the page cache with `sendfile`. """
+        with open(file_path, 'rb', buffering=0) as file:
+            size = os.fstat(file.fileno()).st_size
+            # an empty file cannot be mapped
+            if size == 0:
+                sock.sendall(self._buf_header)
+            elif size < self.sendfile_threshold:
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as rdf_data:
+                    _sendmsg_all(sock, self._buf_header, rdf_data)
+            else:
+                _sendfile_corked(sock, self._buf_header, file)
 
     def process_server_response(self, sock, file_path):
         """ process the server's response to the RDF data. """
-        server_response = sock.recv(1024).decode('utf-8')
-        if server_response.startswith(self.success_prefix) and self.mode == "detailed":
-            self.logger.info(f"Success for {file_path}: {server_response}")
-        elif server_response.startswith(self.error_prefix):
-            error_message = server_response[len(self.error_prefix + ' '):]
-            raise ServerResponseError(f"Failure for {file_path}: {error_message}")
+        self.check_response(self._reader.read_message(), file_path)
+
+    def check_response(self, response: bytes, file_path):
+        """ check a response read from the server to the RDF data of a file. The
+        response is only decoded for a log line or an error message, and bytes
+        outside ASCII are replaced rather than failing the decode. """
+        success, error_message = self._parse(response)
+        if success:
+            if self._detailed and self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(f"Success for {os.fspath(file_path)}: {response.decode('ascii', errors='replace')}")
+        elif success is False:
+            error_message = error_message.decode('ascii', errors='replace')
+            raise ServerResponseError(f"Failure for {os.fspath(file_path)}: {error_message}")
         else:
-            raise ServerResponseError(f"Unexpected response for {file_path}: {server_response}")
+            raise ServerResponseError(f"Unexpected response for {os.fspath(file_path)}: {response.decode('ascii', errors='replace')}")
 
-    def send_file(self, file_path: Path) -> Tuple[float, bool]:
-        """ send an RDF file to the server and process the server's response. """
-        start_time = time.time()
+    def submit_file(self, file_path: Path) -> None:
+        """ send an RDF file to the server without waiting for its response,
+        raising ConnectionError if the connection is lost. """
+        start_time = time.perf_counter_ns()
+        try:
+            if self._sender is not None:
+                # a full batch is flushed here, along with the files queued before this one
+                self._sender.queue_file(file_path)
+            else:
+                self.send_rdf_data(self.sock, file_path)
+        except OSError as e:
+            raise ConnectionError(f"Connection lost while sending {os.fspath(file_path)}: {e}")
+        self._inflight.append((file_path, start_time))
+
+    def reap_one(self) -> Tuple[Path, int, bool]:
+        """ process the server's response to the oldest file still in flight,
+        raising ConnectionError if the connection is lost. """
+        file_path, start_time = self._inflight.popleft()
         success_flag = False
         try:
-            self.send_rdf_data(self.sock, file_path)
+            if self._sender is not None:
+                # the file may still be waiting in an unsubmitted batch
+                self._sender.flush()
             self.process_server_response(self.sock, file_path)
             success_flag = True
-        except (ConnectionError, NoAcknowledgmentError, ServerResponseError) as e:
+        except (NoAcknowledgmentError, ServerResponseError) as e:
             self.logger.error(e)
             print(e, file=sys.stderr)
-        return time.time() - start_time, success_flag
+        except (ConnectionError, OSError) as e:
+            raise ConnectionError(f"Connection lost while sending {os.fspath(file_path)}: {e}")
+        return file_path, time.perf_counter_ns() - start_time, success_flag
 
-    def replay_xmlnews(self, directory: Path) -> None:
-        """ open a directory of XMLNews stories and send them to the server for processing. """
+    def send_file(self, file_path: Path) -> Tuple[int, bool]:
+        """ send an RDF file to the server and process the server's response. """
+        start_time = time.perf_counter_ns()
         try:
-            self.establish_and_validate_connection()
-        except (ConnectionError, NoAcknowledgmentError) as e:
-            self.logger.error(f"Initial connection failed: {e}")
-            print(f"Initial connection failed: {e}", file=sys.stderr)
-            self.sock.close()
-            return
+            self.submit_file(file_path)
+            _, time_taken, success_flag = self.reap_one()
+        except ConnectionError as e:
+            self.logger.error(e)
+            print(e, file=sys.stderr)
+            self._inflight.clear()
+            return time.perf_counter_ns() - start_time, False
+        return time_taken, success_flag
 
-        _, xml_files = self.count_xml_files(directory)
-        file_times = []
+    def replay_files(self, xml_files) -> Tuple[int, int, int]:
+        """ send files to the server, keeping up to `window` of them in flight,
+        until they run out or the connection is lost, and return the number of successful files, their total time in
+        nanoseconds and the error count. """
+        success_file_count = 0
+        file_time_ns = 0
         error_count = 0
 
-        for file_path in xml_files:
-            if self.mode == "detailed":
-                self.logger.info(f"Sending {file_path} to {self.server_ip}:{self.server_port}")
-
-            time_taken, success = self.send_file(file_path)
+        def reap():
+            nonlocal success_file_count, file_time_ns, error_count
+            _, time_taken, success = self.reap_one()
             if success:
-                file_times.append(time_taken)
+                success_file_count += 1
+                file_time_ns += time_taken
             else:
                 error_count += 1
 
-        total_time = sum(file_times)
-        success_file_count = len(file_times)
+        # with io_uring, make room for a whole batch at once so its sends go out together
+        refill = self._sender.batch_size if self._sender is not None else 1
+        try:
+            for file_path in xml_files:
+                if self._detailed and self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug(f"Sending {os.fspath(file_path)} to {self.server_ip}:{self.server_port}")
+                if len(self._inflight) >= self.window:
+                    while len(self._inflight) > self.window - refill:
+                        reap()
+                self.submit_file(file_path)
+
+            while self._inflight:
+                reap()
+        except ConnectionError as e:
+            # the stream is unusable, so the files still in flight are lost with this one
+            self.logger.error(e)
+            print(e, file=sys.stderr)
+            error_count += 1 + len(self._inflight)
+            self._inflight.clear()
+        return success_file_count, file_time_ns, error_count
+
+    def log_summary(self, success_file_count: int, file_time_ns: int, error_count: int,
+                    total_time_ns: int) -> None:
+        """ log the number of files processed, the errors and the timing of a
+        replay. Times are in nanoseconds and only converted to seconds here.
+        A file's time runs from sending it to reading its response, so with a
+        window above 1 it includes waiting behind the files in flight before it. """
+        total_time = total_time_ns / 1e9
         self.logger.info(
             f"Processed {success_file_count} files with {error_count} errors in {total_time:.2f} seconds."
         )
         if success_file_count > 0:
             self.logger.info(
-                f"Average processing time per successful file: {total_time / len(file_times):.2f} seconds."
+                f"Average time from send to response per successful file: {file_time_ns / success_file_count / 1e9:.2f} seconds."
             )
 
-        self.sock.close()
+    def replay_xmlnews(self, directory: Path) -> None:
+        """ open a directory of XMLNews stories and send them to the server for processing. """
+        try:
+            self.establish_and_validate_connection()
+        except (ConnectionError, NoAcknowledgmentError) as e:
+            self.logger.error(f"Initial connection failed: {e}")
+            print(f"Initial connection failed: {e}", file=sys.stderr)
+            self.close()
+            return
+        try:
+            xml_files = iter_xml_files(directory)
+        except OSError as e:
+            self.logger.error(f"Listing the directory failed: {e}")
+            print(f"Listing the directory failed: {e}", file=sys.stderr)
+            self.close()
+            return
+
+        try:
+            start_time = time.perf_counter_ns()
+            with _prefetch_executor() as prefetcher:
+                stats = self.replay_files(_prefetched(xml_files, prefetcher))
+            self.log_summary(*stats, time.perf_counter_ns() - start_time)
+        finally:
+            self.close()
+
+    async def open_connection_async(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """ establish a connection to the server on the running event loop and
+        validate the server's acknowledgment. """
+        loop = asyncio.get_running_loop()
+        sock = self.new_socket()
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, (self.server_ip, self.server_port)), 10)
+            reader, writer = await asyncio.open_connection(sock=sock)
+        except (OSError, asyncio.TimeoutError) as e:
+            sock.close()
+            raise ConnectionError(f"Failed to connect to {self.server_ip}:{self.server_port}: {e}")
+        # asyncio enables TCP_NODELAY on its own, honour the setting either way
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.nodelay))
+        try:
+            self.check_acknowledgment(await self._read_response_async(reader))
+        except (ConnectionError, NoAcknowledgmentError):
+            writer.close()
+            raise
+        return reader, writer
+
+    async def _within_timeout(self, awaitable):
+        """ await a step of talking to the server, giving up after the same 10
+        seconds as the socket timeout of the blocking paths. """
+        try:
+            return await asyncio.wait_for(awaitable, 10)
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"Timed out waiting for {self.server_ip}:{self.server_port}")
+
+    @staticmethod
+    async def _read_line(reader: asyncio.StreamReader) -> bytes:
+        """ read up to and including the next newline. A line longer than the
+        reader's limit is collected in pieces rather than failing, like the
+        growing buffer of the blocking paths. """
+        pieces = []
+        while True:
+            try:
+                pieces.append(await reader.readuntil(b"\n"))
+                return b"".join(pieces)
+            except asyncio.LimitOverrunError as e:
+                pieces.append(await reader.readexactly(e.consumed))
+
+    async def _read_response_async(self, reader: asyncio.StreamReader) -> bytes:
+        """ read a single newline-terminated message from the server without its line ending. """
+        try:
+            response = await self._within_timeout(self._read_line(reader))
+        except asyncio.IncompleteReadError:
+            raise ConnectionError(f"Connection to {self.server_ip}:{self.server_port} closed by server")
+        return response.rstrip(b"\r\n")
+
+    async def _send_file(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, file_path: Path) -> None:
+        """ send an RDF file to the server and check the server's response. Large
+        files go through `loop.sendfile`, which uses `os.sendfile` where the
+        platform has it. Small ones are read, since the transport may keep a
+        reference to a mapping after `write` returns. """
+        with open(file_path, 'rb', buffering=0) as file:
+            size = os.fstat(file.fileno()).st_size
+            rdf_data = file.read() if size < self.sendfile_threshold else None
+            # past this point any failure leaves the stream in an unknown state
+            try:
+                if rdf_data is not None:
+                    writer.writelines([self._buf_header, rdf_data])
+                else:
+                    writer.write(self._buf_header)
+                    await self._within_timeout(asyncio.get_running_loop().sendfile(writer.transport, file))
+                await self._within_timeout(writer.drain())
+                response = await self._read_response_async(reader)
+            except (ConnectionError, OSError) as e:
+                raise ConnectionError(f"Connection lost while sending {os.fspath(file_path)}: {e}")
+        self.check_response(response, file_path)
+
+    async def _worker(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                      paths: asyncio.Queue) -> Tuple[int, int, int]:
+        """ send files from the queue over one connection until the queue ends or the connection is lost. """
+        success_file_count = 0
+        file_time_ns = 0
+        error_count = 0
+        try:
+            # a None marks the end of the queue
+            while (file_path := await paths.get()) is not None:
+                if self._detailed and self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug(f"Sending {os.fspath(file_path)} to {self.server_ip}:{self.server_port}")
+                start_time = time.perf_counter_ns()
+                try:
+                    await self._send_file(reader, writer, file_path)
+                    success_file_count += 1
+                    file_time_ns += time.perf_counter_ns() - start_time
+                except ConnectionError as e:
+                    # the other workers take the rest of the queue
+                    self.logger.error(e)
+                    print(e, file=sys.stderr)
+                    error_count += 1
+                    break
+                except (ServerResponseError, OSError) as e:
+                    self.logger.error(e)
+                    print(e, file=sys.stderr)
+                    error_count += 1
+            return success_file_count, file_time_ns, error_count
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _list_xml_files(xml_files: Iterator[os.DirEntry], paths: asyncio.Queue, worker_count: int) -> None:
+        """ put the XML files of a directory listing on the queue as it drains,
+        followed by a None for every worker. """
+        cancelled = False
+        try:
+            with _prefetch_executor() as prefetcher:
+                for file_path in _prefetched(xml_files, prefetcher):
+                    await paths.put(file_path)
+        except asyncio.CancelledError:
+            # only cancelled once no worker is left to take a None
+            cancelled = True
+            raise
+        finally:
+            if not cancelled:
+                for _ in range(worker_count):
+                    await paths.put(None)
+
+    async def _run(self, directory: Path, concurrency: int) -> None:
+        """ send a directory of XMLNews stories over `concurrency` connections
+        driven by the running event loop. """
+        connections = await asyncio.gather(*(self.open_connection_async() for _ in range(concurrency)),
+                                           return_exceptions=True)
+        failures = [c for c in connections if isinstance(c, BaseException)]
+        if failures:
+            for connection in connections:
+                if not isinstance(connection, BaseException):
+                    connection[1].close()
+            self.logger.error(f"Initial connection failed: {failures[0]}")
+            print(f"Initial connection failed: {failures[0]}", file=sys.stderr)
+            return
+        try:
+            xml_files = iter_xml_files(directory)
+        except OSError as e:
+            for _, writer in connections:
+                writer.close()
+            self.logger.error(f"Listing the directory failed: {e}")
+            print(f"Listing the directory failed: {e}", file=sys.stderr)
+            return
+
+        # the directory is listed while the workers send, a few paths ahead of them
+        paths = asyncio.Queue(maxsize=4 * concurrency)
+        start_time = time.perf_counter_ns()
+        listing = asyncio.create_task(self._list_xml_files(xml_files, paths, concurrency))
+        try:
+            results = await asyncio.gather(*(self._worker(reader, writer, paths) for reader, writer in connections))
+        finally:
+            # if every worker stopped early, nothing is left to take from the queue
+            listing.cancel()
+        await asyncio.wait([listing])
+        if not listing.cancelled():
+            # a listing that failed partway raises here
+            listing.result()
+        self.log_summary(*map(sum, zip(*results)), time.perf_counter_ns() - start_time)
+
+    def replay_xmlnews_async(self, directory: Path, concurrency: int = 8) -> None:
+        """ open a directory of XMLNews stories and send them to the server over
+        `concurrency` connections multiplexed on a single asyncio event loop,
+        which avoids a thread and its stack per connection. """
+        asyncio.run(self._run(directory, concurrency))
+
+def _drain(paths: queue.Queue) -> Iterator[Path]:
+    """ yield paths from a queue until the None that marks its end. """
+    while (file_path := paths.get()) is not None:
+        yield file_path
+
+def replay_parallel(directory: Path, server_ip: str, server_port: int, concurrency: int = 8, **kwargs) -> None:
+    """ open a directory of XMLNews stories and send them to the server over
+    `concurrency` connections at once, each driven by its own thread and
+    ClusterDTester. Further keyword arguments are passed to ClusterDTester.
+
+    Throughput grows with the number of connections only up to a knee,
+    typically somewhere between 8 and 32, past which the server or the link
+    is saturated and extra connections just add contention; measure before
+    raising the default of 8.
+    """
+    testers = [ClusterDTester(server_ip, server_port, **kwargs) for _ in range(concurrency)]
+    logger = testers[0].logger
+    try:
+        for tester in testers:
+            tester.establish_and_validate_connection()
+    except (ConnectionError, NoAcknowledgmentError) as e:
+        logger.error(f"Initial connection failed: {e}")
+        print(f"Initial connection failed: {e}", file=sys.stderr)
+        for tester in testers:
+            tester.close()
+        return
+    try:
+        xml_files = iter_xml_files(directory)
+    except OSError as e:
+        logger.error(f"Listing the directory failed: {e}")
+        print(f"Listing the directory failed: {e}", file=sys.stderr)
+        for tester in testers:
+            tester.close()
+        return
+
+    # the directory is listed while the workers send, a few paths ahead of them
+    paths = queue.Queue(maxsize=4 * concurrency)
+
+    # a worker that loses its connection leaves the rest of the queue to the others
+    live_workers = len(testers)
+    live_lock = threading.Lock()
+
+    def worker(tester: ClusterDTester) -> Tuple[int, int, int]:
+        nonlocal live_workers
+        listing = _drain(paths)
+        try:
+            return tester.replay_files(listing)
+        finally:
+            tester.close()
+            with live_lock:
+                live_workers -= 1
+                last = live_workers == 0
+            if last:
+                # keep taking paths so the listing cannot block with nobody left. The
+                # same generator is resumed, so once it has taken this worker's None
+                # it yields nothing and leaves the other workers' ones alone
+                for _ in listing:
+                    pass
+
+    start_time = time.perf_counter_ns()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(worker, tester) for tester in testers]
+        try:
+            with _prefetch_executor() as prefetcher:
+                for file_path in _prefetched(xml_files, prefetcher):
+                    paths.put(file_path)
+        finally:
+            for _ in testers:
+                paths.put(None)
+        results = [future.result() for future in futures]
+    testers[0].log_summary(*map(sum, zip(*results)), time.perf_counter_ns() - start_time)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Test a daemon service by replaying XMLNews stories.")
@@ -164,10 +772,28 @@ if __name__ == "__main__":
     parser.add_argument("server_ip", help="The IP address of the server running the daemon service.")
     parser.add_argument("server_port", type=int, help="The port number of the server.")
     parser.add_argument("--mode", choices=["fast", "detailed"], default="fast", help="Run mode: 'fast' for minimal logging and speed statistics, 'detailed' for a listing of clusters and duplicates.")
+    parser.add_argument("--verbose", action="store_true", help="Also print the per-file lines of detailed mode to the console, not just to the log file.")
+    parser.add_argument("--window", type=int, default=1, help="The maximum number of files sent to the server before their responses are read. Values above 1 need a server that finds where each BUF payload ends by itself. Ignored with --io asyncio, which always waits for each response.")
+    parser.add_argument("--concurrency", type=int, default=8, help="The number of connections to the server used in parallel.")
+    parser.add_argument("--io-uring", action="store_true", help="Submit sends in batches of up to --window files, at most 32, through io_uring when the liburing bindings are available. Needs --window above 1.")
+    parser.add_argument("--sqpoll", action="store_true", help="With --io-uring, let a kernel thread poll for submissions.")
+    parser.add_argument("--io", choices=["threads", "asyncio"], default="threads", help="Drive parallel connections with a thread per connection, or with one asyncio event loop.")
     args = parser.parse_args()
+    log_listener = _configure_logging(args.mode == "detailed", args.verbose)
 
-    tester = ClusterDTester(args.server_ip, args.server_port, args.mode)
-    tester.replay_xmlnews(Path(args.directory))
+    try:
+        if args.io == "asyncio":
+            tester = ClusterDTester(args.server_ip, args.server_port, args.mode, window=args.window)
+            tester.replay_xmlnews_async(Path(args.directory), args.concurrency)
+        elif args.concurrency > 1:
+            replay_parallel(Path(args.directory), args.server_ip, args.server_port, args.concurrency,
+                            mode=args.mode, window=args.window, io_uring=args.io_uring, sqpoll=args.sqpoll)
+        else:
+            tester = ClusterDTester(args.server_ip, args.server_port, args.mode, window=args.window,
+                                    io_uring=args.io_uring, sqpoll=args.sqpoll)
+            tester.replay_xmlnews(Path(args.directory))
+    finally:
+        log_listener.stop()
 
 # Run the script with the following command:
 # python clusterd_tester.py /path/to/xmlnews/directory
\ No newline at end of file
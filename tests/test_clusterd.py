@@ -1,31 +1,66 @@
 from sys import exc_info
+import asyncio
+import logging
+import queue
+import threading
 import pytest
 import socket
+import struct
 from pathlib import Path
-from unittest.mock import mock_open, patch, MagicMock
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock
 
-from clusterd_tester import ClusterDTester, NoAcknowledgmentError, ConnectionError
+from clusterd_tester import ClusterDTester, NoAcknowledgmentError, ConnectionError, ServerResponseError, _BufPool, _ResponseReader, _prefetched, _will_need, iter_xml_files, replay_parallel
+
+def recv_into_chunks(*chunks):
+    """ build a `recv_into` side effect that delivers the given chunks in order """
+    remaining = iter(chunks)
+    def recv_into(view):
+        data = next(remaining)
+        view[:len(data)] = data
+        return len(data)
+    return recv_into
+
+def sendmsg_into(sent):
+    """ build a `sendmsg` side effect that records each message sent in full """
+    def sendmsg(buffers):
+        sent.append(b"".join(bytes(b) for b in buffers))
+        return len(sent[-1])
+    return sendmsg
+
+def responding_socket():
+    """ build a mock socket that greets the client and answers every file sent with a success """
+    sock = MagicMock()
+    pending = [b'+RCLUSTER Version v1.10\r\n']
+    def sendmsg(buffers):
+        pending.append(b'+RCLUSTER Success Message\r\n')
+        return sum(len(b) for b in buffers)
+    sock.sendmsg.side_effect = sendmsg
+    sock.recv_into.side_effect = lambda view: recv_into_chunks(pending.pop(0))(view)
+    return sock
 
 @patch("socket.socket")
-def test_send_file_success(mock_socket):
+def test_send_file_success(mock_socket, tmp_path):
     """ mock the socket instance to simulate a successful connection and response """
+    sent = []
     mock_sock_instance = MagicMock()
-    mock_sock_instance.recv.side_effect = [b'+RCLUSTER Version v1.10', b'+RCLUSTER Success Message']
+    mock_sock_instance.sendmsg.side_effect = sendmsg_into(sent)
+    mock_sock_instance.recv_into.side_effect = recv_into_chunks(b'+RCLUSTER Version v1.10\r\n', b'+RCLUSTER Success Message\r\n')
     mock_socket.return_value = mock_sock_instance
 
     # instantiate ClusterDTester
     tester = ClusterDTester("127.0.0.1", 12345, "detailed")
     tester.establish_and_validate_connection()
 
-    # mock file opening and reading
-    with patch("pathlib.Path.open", mock_open(read_data=b"Test RDF data")):
-        file_path = Path("dummy_path.xml")  # dummy path for testing
-        time_taken, success = tester.send_file(file_path)
+    file_path = tmp_path / "dummy_path.xml"
+    file_path.write_bytes(b"Test RDF data")
+    time_taken, success = tester.send_file(file_path)
 
     # assertions to check function behavior
     assert mock_socket.called
     mock_sock_instance.connect.assert_called_once_with(("127.0.0.1", 12345))
-    mock_sock_instance.sendall.assert_called_once_with(b"BUFTest RDF data")
+    mock_sock_instance.setsockopt.assert_any_call(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    assert sent == [b"BUFTest RDF data"]
     assert success
     assert time_taken >= 0.0
 
@@ -33,7 +68,7 @@ def test_send_file_success(mock_socket):
 def test_no_acknowledgment_error(mock_socket):
     """ simulate no acknowledgment error exception """ 
     mock_sock_instance = MagicMock()
-    mock_sock_instance.recv.return_value = b'Wrong Response'
+    mock_sock_instance.recv_into.side_effect = recv_into_chunks(b'Wrong Response\r\n')
     mock_socket.return_value = mock_sock_instance
 
     tester = ClusterDTester("127.0.0.1", 12345, "detailed")
@@ -42,19 +77,20 @@ def test_no_acknowledgment_error(mock_socket):
         tester.establish_and_validate_connection()
 
 @patch("socket.socket")
-def test_server_response_error(mock_socket):
+def test_server_response_error(mock_socket, tmp_path):
     """ similate server response error """
     mock_sock_instance = MagicMock()
-    mock_sock_instance.recv.side_effect = [b'+RCLUSTER Version v1.10', 
-                                           b'-RCLUSTER (100) Service Unavailable']
+    mock_sock_instance.sendmsg.side_effect = sendmsg_into([])
+    mock_sock_instance.recv_into.side_effect = recv_into_chunks(b'+RCLUSTER Version v1.10\r\n', 
+                                                                b'-RCLUSTER (100) Service Unavailable\r\n')
     mock_socket.return_value = mock_sock_instance
 
     tester = ClusterDTester("127.0.0.1", 12345, "detailed")
     tester.establish_and_validate_connection()
     
-    with patch("pathlib.Path.open", mock_open(read_data=b"Test RDF data")):
-        file_path = Path("dummy_path.xml")
-        time_taken, success = tester.send_file(file_path)
+    file_path = tmp_path / "dummy_path.xml"
+    file_path.write_bytes(b"Test RDF data")
+    time_taken, success = tester.send_file(file_path)
 
     assert not success
     assert time_taken >= 0.0
@@ -68,3 +104,349 @@ def test_connection_error(mock_socket):
 
     with pytest.raises(ConnectionError):
         tester.establish_connection()
+
+@patch("socket.socket")
+def test_replay_files_pipelined(mock_socket, tmp_path):
+    """ simulate responses to several in-flight files arriving split and merged across reads """
+    sent = []
+    mock_sock_instance = MagicMock()
+    mock_sock_instance.sendmsg.side_effect = sendmsg_into(sent)
+    mock_sock_instance.recv_into.side_effect = recv_into_chunks(
+        b'+RCLUSTER Version v1.10\r\n+RCL',
+        b'USTER One\r\n-RCLUSTER (100) Service Unavailable\r\n+RCLUSTER Three\r\n')
+    mock_socket.return_value = mock_sock_instance
+
+    tester = ClusterDTester("127.0.0.1", 12345, "fast", window=2)
+    tester.establish_and_validate_connection()
+
+    file_paths = [tmp_path / f"dummy_{i}.xml" for i in range(3)]
+    for file_path in file_paths:
+        file_path.write_bytes(b"Test RDF data")
+    success_file_count, file_time_ns, error_count = tester.replay_files(file_paths)
+
+    assert sent == [b"BUFTest RDF data"] * 3
+    assert success_file_count == 2
+    assert file_time_ns >= 0
+    assert error_count == 1
+
+def test_response_reader_grows_buffer():
+    """ a message longer than the receive buffer is reassembled in a grown buffer """
+    # a plain namespace rather than a MagicMock, which would hold on to the views passed in
+    sock = SimpleNamespace(recv_into=recv_into_chunks(b'+RCLUS', b'TER Lo', b'ng\r\n-R', b'CLUSTER\r\n'))
+
+    reader = _ResponseReader(sock, bytearray(6))
+
+    assert reader.read_message() == b'+RCLUSTER Long'
+    assert reader.read_message() == b'-RCLUSTER'
+    assert len(reader.buf) == 24
+
+@patch("socket.socket")
+def test_send_file_large_uses_sendfile(mock_socket, tmp_path):
+    """ files at or above the sendfile threshold go through sendfile behind the header """
+    mock_sock_instance = MagicMock()
+    mock_sock_instance.recv_into.side_effect = recv_into_chunks(b'+RCLUSTER Version v1.10\r\n', b'+RCLUSTER Success Message\r\n')
+    mock_socket.return_value = mock_sock_instance
+
+    tester = ClusterDTester("127.0.0.1", 12345, "fast", sendfile_threshold=4)
+    tester.establish_and_validate_connection()
+
+    file_path = tmp_path / "dummy_path.xml"
+    file_path.write_bytes(b"Test RDF data")
+    time_taken, success = tester.send_file(file_path)
+
+    assert success
+    if hasattr(socket, "MSG_MORE"):
+        mock_sock_instance.sendall.assert_called_once_with(b"BUF", socket.MSG_MORE)
+    else:
+        mock_sock_instance.sendall.assert_called_once_with(b"BUF")
+    assert mock_sock_instance.sendfile.call_count == 1
+    assert not mock_sock_instance.sendmsg.called
+
+@patch("socket.socket")
+def test_replay_parallel(mock_socket, tmp_path):
+    """ files in a directory are spread over several connections """
+    socks = [responding_socket(), responding_socket()]
+    mock_socket.side_effect = socks
+    for i in range(5):
+        (tmp_path / f"dummy_{i}.xml").write_bytes(b"Test RDF data")
+
+    replay_parallel(tmp_path, "127.0.0.1", 12345, concurrency=2)
+
+    assert sum(sock.sendmsg.call_count for sock in socks) == 5
+    for sock in socks:
+        sock.connect.assert_called_once_with(("127.0.0.1", 12345))
+        sock.close.assert_called_once()
+
+@patch("socket.socket")
+def test_replay_missing_directory(mock_socket, tmp_path, capsys):
+    """ a directory that cannot be listed is reported without a traceback """
+    socks = [responding_socket(), responding_socket()]
+    mock_socket.side_effect = socks
+
+    replay_parallel(tmp_path / "missing", "127.0.0.1", 12345, concurrency=2)
+
+    assert "Listing the directory failed" in capsys.readouterr().err
+    for sock in socks:
+        assert not sock.sendmsg.called
+        sock.close.assert_called_once()
+
+def test_replay_xmlnews_async(tmp_path):
+    """ files are sent over asyncio connections to a local server """
+    received = []
+
+    async def handle(reader, writer):
+        writer.write(b'+RCLUSTER Version v1.10\r\n')
+        while data := await reader.read(65536):
+            received.append(data)
+            writer.write(b'+RCLUSTER Success Message\r\n')
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            tester = ClusterDTester("127.0.0.1", port, "fast")
+            await tester._run(tmp_path, 2)
+
+    for i in range(3):
+        (tmp_path / f"dummy_{i}.xml").write_bytes(b"Test RDF data")
+    asyncio.run(main())
+
+    assert received == [b"BUFTest RDF data"] * 3
+
+def test_replay_xmlnews_async_connection_reset(tmp_path):
+    """ a connection reset by the server ends its worker, and the other connection sends the rest """
+    resets = []
+
+    async def handle(reader, writer):
+        writer.write(b'+RCLUSTER Version v1.10\r\n')
+        while await reader.read(65536):
+            if not resets:
+                # a zero linger time makes closing send a reset
+                resets.append(writer)
+                writer.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                writer.transport.abort()
+                return
+            writer.write(b'+RCLUSTER Success Message\r\n')
+        writer.close()
+
+    async def main():
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            tester = ClusterDTester("127.0.0.1", port, "fast")
+            with patch.object(tester, "log_summary") as log_summary:
+                await tester._run(tmp_path, 2)
+        return log_summary.call_args.args[:3:2]
+
+    for i in range(40):
+        (tmp_path / f"dummy_{i}.xml").write_bytes(b"Test RDF data")
+    success_file_count, error_count = asyncio.run(main())
+
+    assert (success_file_count, error_count) == (39, 1)
+
+def test_replay_xmlnews_async_listing_fails(tmp_path):
+    """ a listing that fails partway ends the run with its error instead of leaving the workers waiting """
+    async def handle(reader, writer):
+        writer.write(b'+RCLUSTER Version v1.10\r\n')
+        while await reader.read(65536):
+            writer.write(b'+RCLUSTER Success Message\r\n')
+        writer.close()
+
+    def failing_listing(directory):
+        yield tmp_path / "dummy_0.xml"
+        raise OSError("Listing interrupted")
+
+    async def main():
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            tester = ClusterDTester("127.0.0.1", port, "fast")
+            await asyncio.wait_for(tester._run(tmp_path, 2), 5)
+
+    (tmp_path / "dummy_0.xml").write_bytes(b"Test RDF data")
+    with patch("clusterd_tester.iter_xml_files", failing_listing):
+        with pytest.raises(OSError, match="Listing interrupted"):
+            asyncio.run(main())
+
+def test_iouring_sender(tmp_path):
+    """ a batch of files queued on io_uring arrives in order on the socket """
+    pytest.importorskip("liburing")
+    from _iouring_backend import IoUringSender
+
+    client, server = socket.socketpair()
+    sender = IoUringSender(client, b"BUF", batch_size=2)
+    try:
+        for i in range(3):
+            file_path = tmp_path / f"dummy_{i}.xml"
+            file_path.write_bytes(f"Test RDF data {i}".encode())
+            sender.queue_file(file_path)
+        sender.flush()
+    finally:
+        sender.close()
+        client.close()
+
+    with server:
+        assert server.recv(1024) == b"BUFTest RDF data 0BUFTest RDF data 1BUFTest RDF data 2"
+
+@patch("socket.socket")
+def test_failed_uring_flush_counts_as_error(mock_socket, tmp_path):
+    """ a batch that io_uring fails to send is an error for the file, not a crash """
+    mock_socket.return_value = responding_socket()
+    tester = ClusterDTester("127.0.0.1", 12345, "detailed")
+    tester.establish_and_validate_connection()
+    tester._sender = MagicMock()
+    tester._sender.flush.side_effect = OSError("Short send of 0 bytes through io_uring")
+
+    file_path = tmp_path / "dummy_path.xml"
+    file_path.write_bytes(b"Test RDF data")
+    time_taken, success = tester.send_file(file_path)
+
+    assert not success
+    assert not tester._inflight
+
+@patch("socket.socket")
+def test_failed_uring_batch_counts_in_flight_files(mock_socket, tmp_path):
+    """ a batch that fails while a file is queued counts the file and those in flight as errors """
+    mock_sock_instance = MagicMock()
+    mock_sock_instance.recv_into.side_effect = recv_into_chunks(b'+RCLUSTER Version v1.10\r\n', b'+RCLUSTER Success Message\r\n')
+    mock_socket.return_value = mock_sock_instance
+    tester = ClusterDTester("127.0.0.1", 12345, "fast", window=2)
+    tester.establish_and_validate_connection()
+    tester._sender = MagicMock(batch_size=1)
+    tester._sender.queue_file.side_effect = [None, None, ConnectionResetError(104, "Connection reset by peer")]
+
+    file_paths = [tmp_path / f"dummy_{i}.xml" for i in range(4)]
+    for file_path in file_paths:
+        file_path.write_bytes(b"Test RDF data")
+    success_file_count, _, error_count = tester.replay_files(file_paths)
+
+    assert (success_file_count, error_count) == (1, 2)
+    assert tester._sender.queue_file.call_count == 3
+
+@patch("socket.socket")
+def test_iouring_needs_window(mock_socket, caplog):
+    """ io_uring with a window of 1 has nothing to batch, so plain sockets are used """
+    mock_socket.return_value = responding_socket()
+    tester = ClusterDTester("127.0.0.1", 12345, "fast", io_uring=True)
+
+    with caplog.at_level(logging.WARNING, logger="clusterd_tester"):
+        tester.establish_and_validate_connection()
+
+    assert tester._sender is None
+    assert "window above 1" in caplog.text
+
+def test_iter_xml_files(tmp_path):
+    """ only regular files ending in .xml are listed """
+    (tmp_path / "story.xml").write_bytes(b"Test RDF data")
+    (tmp_path / "notes.txt").write_bytes(b"Test notes")
+    (tmp_path / "folder.xml").mkdir()
+
+    assert [entry.name for entry in iter_xml_files(tmp_path)] == ["story.xml"]
+
+def test_check_response_undecodable_error():
+    """ an error message that is not ASCII still raises a server response error """
+    tester = ClusterDTester("127.0.0.1", 12345, "fast")
+
+    tester.check_response(b'+RCLUSTER Success Message', Path("dummy_path.xml"))
+    with pytest.raises(ServerResponseError, match="Service \ufffd"):
+        tester.check_response(b'-RCLUSTER (100) Service \xff', Path("dummy_path.xml"))
+
+def test_prefetched_keeps_order():
+    """ files come out in order while hints run ahead of them """
+    executor = MagicMock()
+    prefetched = _prefetched(iter(range(5)), executor, depth=2)
+
+    assert next(prefetched) == 0
+    assert executor.submit.call_count == 3
+    assert list(prefetched) == [1, 2, 3, 4]
+    executor.submit.assert_called_with(_will_need, 4)
+
+def test_prefetched_without_executor():
+    """ without an executor the files are passed through unchanged """
+    assert list(_prefetched(iter(range(5)), None)) == [0, 1, 2, 3, 4]
+
+def test_buf_pool_reuses_grown_buffers(monkeypatch):
+    """ a returned buffer is handed out again, and sets the size of new ones """
+    # a pool of its own, so the shared one is left as the other tests expect it
+    monkeypatch.setattr(_BufPool, "_free", queue.LifoQueue())
+    monkeypatch.setattr(_BufPool, "_watermark", 0)
+    buf = bytearray(1 << 20)
+    _BufPool.put(buf)
+
+    assert _BufPool.get(16) is buf
+    assert len(_BufPool.get(16)) >= len(buf)
+
+def test_invalid_mode():
+    """ an unknown mode is rejected when the tester is created """
+    with pytest.raises(ValueError):
+        ClusterDTester("127.0.0.1", 12345, "slow")
+
+@patch("socket.socket")
+def test_replay_parallel_worker_fails_after_listing(mock_socket, tmp_path):
+    """ a worker failing on its last response, after the listing has ended, does not hang the replay """
+    socks = []
+    for _ in range(2):
+        sock = MagicMock()
+        sock.sendmsg.side_effect = sendmsg_into([])
+        greeting = recv_into_chunks(b'+RCLUSTER Version v1.10\r\n')
+        def recv_into(view, greeting=greeting, calls=[]):
+            calls.append(view)
+            if len(calls) > 1:
+                raise socket.timeout("timed out")
+            return greeting(view)
+        sock.recv_into.side_effect = recv_into
+        socks.append(sock)
+    mock_socket.side_effect = socks
+    (tmp_path / "dummy_0.xml").write_bytes(b"Test RDF data")
+
+    with patch.object(ClusterDTester, "log_summary") as log_summary:
+        thread = threading.Thread(target=replay_parallel, args=(tmp_path, "127.0.0.1", 12345, 2), daemon=True)
+        thread.start()
+        thread.join(timeout=5)
+
+    assert not thread.is_alive()
+    success_file_count, _, error_count, _ = log_summary.call_args.args
+    assert (success_file_count, error_count) == (0, 1)
+
+@patch("socket.socket")
+def test_replay_parallel_all_connections_lost(mock_socket, tmp_path):
+    """ once every connection is lost the replay still ends and logs its summary """
+    socks = []
+    for _ in range(2):
+        sock = MagicMock()
+        sock.sendmsg.side_effect = sendmsg_into([])
+        greeting = recv_into_chunks(b'+RCLUSTER Version v1.10\r\n')
+        def recv_into(view, greeting=greeting, calls=[]):
+            calls.append(view)
+            if len(calls) > 1:
+                raise ConnectionResetError(104, "Connection reset by peer")
+            return greeting(view)
+        sock.recv_into.side_effect = recv_into
+        socks.append(sock)
+    mock_socket.side_effect = socks
+    # more files than the queue between the listing and the workers holds
+    for i in range(20):
+        (tmp_path / f"dummy_{i}.xml").write_bytes(b"Test RDF data")
+
+    with patch.object(ClusterDTester, "log_summary") as log_summary:
+        thread = threading.Thread(target=replay_parallel, args=(tmp_path, "127.0.0.1", 12345, 2), daemon=True)
+        thread.start()
+        thread.join(timeout=5)
+
+    assert not thread.is_alive()
+    success_file_count, _, error_count, _ = log_summary.call_args.args
+    assert (success_file_count, error_count) == (0, 2)
+    for sock in socks:
+        assert sock.sendmsg.call_count == 1
+        sock.close.assert_called_once()
+
+def test_read_response_async_longer_than_limit():
+    """ a response longer than the stream reader's limit is still read whole """
+    async def main():
+        reader = asyncio.StreamReader(limit=16)
+        reader.feed_data(b'+RCLUSTER ' + b'x' * 100 + b'\r\n+RCLUSTER Next\r\n')
+        tester = ClusterDTester("127.0.0.1", 12345, "fast")
+        return await tester._read_response_async(reader), await tester._read_response_async(reader)
+
+    assert asyncio.run(main()) == (b'+RCLUSTER ' + b'x' * 100, b'+RCLUSTER Next')